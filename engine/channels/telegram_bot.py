@@ -1,17 +1,26 @@
 """Telegram bot — handles incoming messages, generates persona responses with TTS."""
 
+from __future__ import annotations
+
+import asyncio
+import functools
 import json
 import logging
 from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 from uuid import uuid4
 
-from telegram import Update
-from telegram.ext import Application, MessageHandler, filters, ContextTypes
+from sqlalchemy import text
 
 from config import settings
 from db import get_db
 from llm.chain import generate_response
 from llm.tts import text_to_speech
+from metrics import MESSAGES_HANDLED, span, start_metrics_server
+
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import ContextTypes
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [telegram] %(message)s")
 logger = logging.getLogger(__name__)
@@ -20,29 +29,80 @@ RESPONSE_DIR = Path(settings.data_dir) / "audio" / "responses"
 RESPONSE_DIR.mkdir(parents=True, exist_ok=True)
 
 
+class ChatTurn:
+    """Messages from one chat that will be answered with a single reply."""
+
+    def __init__(self):
+        self.texts: list[str] = []
+        self.message_ids: set[int] = set()
+        self.update: Optional[Update] = None
+        self.task: Optional[asyncio.Task] = None
+        # Set once the reply is being sent; later messages start a new turn
+        self.replying = False
+
+
+# Open turn per chat_id. Only touched from the event loop, so no locking.
+_turns: dict[str, ChatTurn] = {}
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle incoming Telegram message."""
+    """Handle incoming Telegram message.
+
+    Messages that arrive within ``telegram_debounce_seconds`` of each other are
+    merged into one turn. A message arriving while that turn's answer is still
+    being generated cancels the generation and restarts it with the new text.
+    """
     if not update.message or not update.message.text:
         return
 
     chat_id = str(update.message.chat_id)
     user_text = update.message.text
-    telegram_user = update.message.from_user
+    logger.info(f"Message from {update.message.from_user.first_name} ({chat_id}): {user_text}")
+
+    turn = _turns.get(chat_id)
+    if turn is None or turn.replying:
+        turn = _turns[chat_id] = ChatTurn()
+
+    # Telegram can redeliver an update, and users double-send
+    if update.message.message_id in turn.message_ids or (turn.texts and turn.texts[-1] == user_text):
+        return
+    turn.message_ids.add(update.message.message_id)
+    turn.texts.append(user_text)
+    turn.update = update
+
+    if turn.task and not turn.task.done():
+        MESSAGES_HANDLED.labels("telegram", "coalesced").inc()
+        turn.task.cancel()
+    turn.task = asyncio.create_task(_answer(chat_id, turn))
+
 
-    logger.info(f"Message from {telegram_user.first_name} ({chat_id}): {user_text}")
+async def _answer(chat_id: str, turn: ChatTurn):
+    """Wait out the debounce window, then reply to everything in ``turn``."""
+    try:
+        await asyncio.sleep(settings.telegram_debounce_seconds)
+        with span("telegram", "handle_message"):
+            await _reply(chat_id, turn)
+    except Exception as e:
+        logger.error(f"Error handling messages from {chat_id}: {e}")
+    finally:
+        if _turns.get(chat_id) is turn and turn.task is asyncio.current_task():
+            del _turns[chat_id]
 
+
+def _load_persona() -> Optional[dict]:
     # Find the persona linked to this bot (MVP: first active persona)
     with get_db() as db:
         persona_row = db.execute(
-            "SELECT p.id, p.user_id, p.name, p.voice_id, p.auto_profile, p.manual_overrides "
-            "FROM personas p WHERE p.voice_status = 'ready' LIMIT 1"
+            text(
+                "SELECT p.id, p.user_id, p.name, p.voice_id, p.auto_profile, p.manual_overrides "
+                "FROM personas p WHERE p.voice_status = 'ready' LIMIT 1"
+            )
         ).fetchone()
 
     if not persona_row:
-        await update.message.reply_text("⚠️ No persona configured yet. Please set up a persona in the dashboard.")
-        return
+        return None
 
-    persona = {
+    return {
         "id": str(persona_row[0]),
         "user_id": str(persona_row[1]),
         "name": persona_row[2],
@@ -51,71 +111,142 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "manual_overrides": persona_row[5] if isinstance(persona_row[5], dict) else json.loads(persona_row[5] or "{}"),
     }
 
-    # Lookup client
+
+def _lookup_client(telegram_user) -> tuple[str, Optional[str]]:
     client_name = telegram_user.first_name
     client_notes = None
     with get_db() as db:
         client_row = db.execute(
-            "SELECT name, notes FROM clients WHERE telegram_id = :tid",
+            text("SELECT name, notes FROM clients WHERE telegram_id = :tid"),
             {"tid": str(telegram_user.id)},
         ).fetchone()
         if client_row:
             client_name = client_row[0] or client_name
             client_notes = client_row[1]
+    return client_name, client_notes
+
+
+def _log_conversation(persona: dict, chat_id: str, user_text: str, response_text: str, audio_path: Optional[Path]):
+    with get_db() as db:
+        conv_id = str(uuid4())
+        db.execute(
+            text(
+                "INSERT INTO conversations (id, persona_id, channel, channel_chat_id) "
+                "VALUES (:id, :pid, 'telegram', :cid)"
+            ),
+            {"id": conv_id, "pid": persona["id"], "cid": chat_id},
+        )
+        db.execute(
+            text("INSERT INTO messages (conversation_id, role, content) VALUES (:cid, 'user', :content)"),
+            {"cid": conv_id, "content": user_text},
+        )
+        db.execute(
+            text("INSERT INTO messages (conversation_id, role, content, audio_url) VALUES (:cid, 'assistant', :content, :audio)"),
+            {"cid": conv_id, "content": response_text, "audio": str(audio_path) if audio_path else None},
+        )
+
+
+def _discard_audio(synthesis: asyncio.Future):
+    """Delete the voice note of a superseded reply once its synthesis finishes."""
+    if not synthesis.cancelled() and synthesis.exception() is None:
+        synthesis.result().unlink(missing_ok=True)
+
+
+async def _reply(chat_id: str, turn: ChatTurn):
+    """Look up persona and client, generate one answer for the turn and send it back.
+
+    Blocking work runs in threads so the bot keeps receiving messages. If this
+    task is cancelled (the turn was superseded), work already running in a
+    thread still finishes: an LLM answer is dropped, and a voice note that was
+    being synthesized is still paid for but deleted once it is written.
+    """
+    update = turn.update
+    user_text = "\n".join(turn.texts)
+
+    with span("telegram", "persona_lookup"):
+        persona = await asyncio.to_thread(_load_persona)
+
+    if not persona:
+        turn.replying = True
+        MESSAGES_HANDLED.labels("telegram", "no_persona").inc()
+        await update.message.reply_text("⚠️ No persona configured yet. Please set up a persona in the dashboard.")
+        return
+
+    with span("telegram", "client_lookup"):
+        client_name, client_notes = await asyncio.to_thread(_lookup_client, update.message.from_user)
 
     # Generate response
     try:
-        response_text = generate_response(
-            persona=persona,
-            user_id=persona["user_id"],
-            question=user_text,
-            client_name=client_name,
-            client_notes=client_notes,
-        )
+        with span("telegram", "generate_response"):
+            response_text = await asyncio.to_thread(
+                generate_response,
+                persona=persona,
+                user_id=persona["user_id"],
+                question=user_text,
+                client_name=client_name,
+                client_notes=client_notes,
+            )
 
         # Generate TTS if voice is available
+        audio_path = None
         if persona["voice_id"]:
             message_id = str(uuid4())
-            audio_path = text_to_speech(
-                text=response_text,
-                voice_id=persona["voice_id"],
-                output_dir=RESPONSE_DIR,
-                message_id=message_id,
+            synthesis = asyncio.get_running_loop().run_in_executor(
+                None,
+                functools.partial(
+                    text_to_speech,
+                    text=response_text,
+                    voice_id=persona["voice_id"],
+                    output_dir=RESPONSE_DIR,
+                    message_id=message_id,
+                ),
             )
-            with open(audio_path, "rb") as audio:
+            try:
+                with span("telegram", "text_to_speech"):
+                    audio_path = await asyncio.shield(synthesis)
+            except asyncio.CancelledError:
+                synthesis.add_done_callback(_discard_audio)
+                raise
+
+        # From here on the reply is committed; new messages start a new turn
+        turn.replying = True
+        if audio_path:
+            with span("telegram", "reply"), open(audio_path, "rb") as audio:
                 await update.message.reply_voice(voice=audio, caption=response_text[:1024])
         else:
-            await update.message.reply_text(response_text)
+            with span("telegram", "reply"):
+                await update.message.reply_text(response_text)
 
         # Log conversation
-        with get_db() as db:
-            conv_id = str(uuid4())
-            db.execute(
-                "INSERT INTO conversations (id, persona_id, channel, channel_chat_id) "
-                "VALUES (:id, :pid, 'telegram', :cid)",
-                {"id": conv_id, "pid": persona["id"], "cid": chat_id},
-            )
-            db.execute(
-                "INSERT INTO messages (conversation_id, role, content) VALUES (:cid, 'user', :content)",
-                {"cid": conv_id, "content": user_text},
-            )
-            db.execute(
-                "INSERT INTO messages (conversation_id, role, content, audio_url) VALUES (:cid, 'assistant', :content, :audio)",
-                {"cid": conv_id, "content": response_text, "audio": str(audio_path) if persona["voice_id"] else None},
-            )
+        with span("telegram", "log_conversation"):
+            await asyncio.to_thread(_log_conversation, persona, chat_id, user_text, response_text, audio_path)
+        MESSAGES_HANDLED.labels("telegram", "replied").inc()
 
     except Exception as e:
+        turn.replying = True
+        MESSAGES_HANDLED.labels("telegram", "failed").inc()
         logger.error(f"Error generating response: {e}")
         await update.message.reply_text("Sorry, I'm having trouble right now. Please try again later.")
 
 
-def main():
-    """Start the Telegram bot."""
+def run():
+    """Poll Telegram for messages until the process is signalled to stop.
+
+    Must run on the main thread, since polling installs signal handlers.
+    """
+    from telegram.ext import Application, MessageHandler, filters
+
     app = Application.builder().token(settings.telegram_bot_token).build()
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     logger.info("Telegram bot started")
     app.run_polling()
 
 
+def main():
+    """Start the Telegram bot."""
+    start_metrics_server(collect_queues=False)
+    run()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,38 @@
+"""Lazily created, process-wide provider clients.
+
+Heavy SDKs are imported on first use, and every worker in the same process
+shares one client (and connection pool) per provider.
+"""
+
+from functools import lru_cache
+
+from config import settings
+
+
+@lru_cache(maxsize=None)
+def openai_client():
+    from openai import OpenAI
+
+    # Retries are owned by ratelimit.call, which shares backoff across workers
+    return OpenAI(api_key=settings.openai_api_key, max_retries=0)
+
+
+@lru_cache(maxsize=None)
+def elevenlabs_client():
+    from elevenlabs import ElevenLabs
+
+    return ElevenLabs(api_key=settings.elevenlabs_api_key)
+
+
+@lru_cache(maxsize=None)
+def chroma_client():
+    import chromadb
+
+    return chromadb.HttpClient(host=settings.chroma_host, port=settings.chroma_port)
+
+
+@lru_cache(maxsize=None)
+def redis_client():
+    import redis
+
+    return redis.from_url(settings.redis_url)
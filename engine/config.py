@@ -12,6 +12,33 @@ class Settings(BaseSettings):
     chroma_host: str = "chroma"
     chroma_port: int = 8000
     data_dir: str = "/data"
+    metrics_port: int = 9100  # 0 disables the /metrics endpoint
+    engine_workers: str = "voice,persona,rag,telegram"  # used by supervisor.py
+    telegram_debounce_seconds: float = 1.5  # merge bursts of messages into one reply
+
+    # Embeddings (see llm/embeddings.py): "openai" or "local" (CPU model)
+    embedding_backend: str = "openai"
+    tenant_embedding_backends: dict[str, str] = {}  # user_id -> backend, as JSON
+    local_embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2"
+    embedding_threads: int = 4
+
+    # Shared provider limits (see ratelimit.py). Background jobs leave
+    # rate_limit_reserve of each bucket for interactive chat traffic.
+    openai_rpm: int = 500
+    openai_tpm: int = 200_000
+    elevenlabs_rpm: int = 100
+    elevenlabs_cpm: int = 100_000  # characters/min
+    rate_limit_reserve: float = 0.2
+    rate_limit_max_wait_interactive: float = 20
+    rate_limit_max_wait_background: float = 600
+
+    # Failed jobs are retried from their last checkpoint (see jobs.py)
+    job_max_attempts: int = 4
+    job_retry_base_seconds: float = 30
+    # A processing job with no heartbeat for this long is assumed orphaned
+    # and is reclaimed; running jobs heartbeat every third of the lease
+    job_lease_seconds: int = 300
+    job_reclaim_interval_seconds: float = 60
 
     class Config:
         env_file = ".env"
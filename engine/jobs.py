@@ -0,0 +1,208 @@
+"""Checkpointed job stages with retry and backoff over the jobs table.
+
+Each stage's output is stored in ``jobs.checkpoints`` as soon as it finishes.
+When a job fails it goes back to ``pending`` with a ``run_after`` backoff, and
+the next attempt skips every stage that already has a checkpoint. A running
+attempt heartbeats ``jobs.heartbeat_at``; jobs whose worker died mid-attempt
+stop heartbeating and are reclaimed by ``reclaim_stale_jobs`` after
+``settings.job_lease_seconds``.
+"""
+
+import json
+import logging
+import threading
+from typing import Any, Callable, Optional
+
+from sqlalchemy import text
+
+from config import settings
+from db import get_db
+from metrics import JOBS_PROCESSED, span
+
+logger = logging.getLogger(__name__)
+
+
+class PermanentJobError(Exception):
+    """A failure that retrying cannot fix; the job is marked failed immediately."""
+
+
+class JobRun:
+    """One attempt at a job, with access to the checkpoints of earlier attempts."""
+
+    def __init__(self, job_id: str, component: str, attempt: int, checkpoints: dict):
+        self.job_id = job_id
+        self.component = component
+        self.attempt = attempt
+        self.checkpoints = checkpoints
+
+    def stage(self, name: str, fn: Callable[..., Any], *args, valid: Optional[Callable[[Any], bool]] = None, **kwargs):
+        """Return ``name``'s checkpointed output, or run ``fn`` and checkpoint its result.
+
+        ``valid`` can reject a stale checkpoint (e.g. a file that no longer
+        exists), in which case the stage runs again. Results must be JSON-serializable.
+        """
+        if name in self.checkpoints and (valid is None or valid(self.checkpoints[name])):
+            logger.info(f"Job {self.job_id}: reusing checkpoint for stage '{name}'")
+            return self.checkpoints[name]
+
+        with span(self.component, name):
+            result = fn(*args, **kwargs)
+        self.save(name, result)
+        return result
+
+    def save(self, name: str, value: Any):
+        """Record ``value`` as the checkpoint for ``name``."""
+        self.checkpoints[name] = value
+        with get_db() as db:
+            db.execute(
+                text(
+                    "UPDATE jobs SET checkpoints = COALESCE(checkpoints, '{}'::jsonb) || CAST(:cp AS jsonb), "
+                    "heartbeat_at = NOW() WHERE id = :id"
+                ),
+                {"cp": json.dumps({name: value}), "id": self.job_id},
+            )
+
+
+def complete(db, job_id: str, output: dict):
+    """Mark a job completed inside the caller's transaction."""
+    db.execute(
+        text("UPDATE jobs SET status = 'completed', completed_at = NOW(), error = NULL, output = :out WHERE id = :id"),
+        {"out": json.dumps(output), "id": job_id},
+    )
+
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff before attempt ``attempt + 1``, capped at 15 minutes."""
+    return min(settings.job_retry_base_seconds * 2 ** (attempt - 1), 900)
+
+
+def _heartbeat(job_id: str, stop_event: threading.Event):
+    """Refresh the job's lease until ``stop_event`` is set."""
+    while not stop_event.wait(settings.job_lease_seconds / 3):
+        try:
+            with get_db() as db:
+                db.execute(text("UPDATE jobs SET heartbeat_at = NOW() WHERE id = :id"), {"id": job_id})
+        except Exception as e:
+            logger.warning(f"Job {job_id} heartbeat failed: {e}")
+
+
+def reclaim_stale_jobs(job_types: list[str]) -> list[str]:
+    """Return jobs left in ``processing`` by a dead worker to ``pending``.
+
+    A job is stale once it has gone ``settings.job_lease_seconds`` without a
+    heartbeat. The interrupted attempt still counts
+    towards ``job_max_attempts``. Returns the reclaimed job ids.
+    """
+    with get_db() as db:
+        rows = db.execute(
+            text(
+                "UPDATE jobs SET status = 'pending', run_after = NULL, "
+                "error = 'Worker stopped during attempt ' || attempts "
+                "WHERE type = ANY(:types) AND status = 'processing' "
+                "AND COALESCE(heartbeat_at, started_at) < NOW() - make_interval(secs => :lease) "
+                "RETURNING id"
+            ),
+            {"types": list(job_types), "lease": settings.job_lease_seconds},
+        ).fetchall()
+    job_ids = [str(row[0]) for row in rows]
+    for job_id in job_ids:
+        logger.warning(f"Reclaimed stale job {job_id}")
+    return job_ids
+
+
+def _fail(
+    job_id: str,
+    job_type: str,
+    error: str,
+    cleanup: Optional[Callable[[], None]],
+    on_failure: Optional[Callable[[], None]],
+):
+    JOBS_PROCESSED.labels(job_type, "failed").inc()
+    with get_db() as db:
+        db.execute(
+            text("UPDATE jobs SET status = 'failed', error = :err, completed_at = NOW() WHERE id = :id"),
+            {"err": error, "id": job_id},
+        )
+    if on_failure:
+        on_failure()
+    if cleanup:
+        cleanup()
+
+
+def run_job(
+    job_id: str,
+    job_type: str,
+    component: str,
+    pipeline: Callable[[JobRun], None],
+    cleanup: Optional[Callable[[], None]] = None,
+    on_failure: Optional[Callable[[], None]] = None,
+) -> Optional[float]:
+    """Run ``pipeline`` as the next attempt of a job.
+
+    The job is claimed only if it is still ``pending``, so a duplicate delivery
+    of a job that is running elsewhere or already finished is a no-op. The
+    pipeline must call ``complete`` when it succeeds. On failure the job is
+    rescheduled with backoff until ``settings.job_max_attempts`` is reached, then
+    marked failed; ``PermanentJobError`` fails it straight away. ``on_failure``
+    runs when the job is marked failed, and ``cleanup`` runs once the job is
+    finished for good, whether completed or failed. Returns the retry delay in
+    seconds if one was scheduled.
+    """
+    with get_db() as db:
+        row = db.execute(
+            text(
+                "UPDATE jobs SET status = 'processing', started_at = NOW(), heartbeat_at = NOW(), "
+                "attempts = COALESCE(attempts, 0) + 1 "
+                "WHERE id = :id AND status = 'pending' RETURNING attempts, checkpoints, error"
+            ),
+            {"id": job_id},
+        ).fetchone()
+    if not row:
+        # Already claimed by another worker, finished, or gone
+        logger.info(f"Job {job_id} is not pending, skipping")
+        return None
+
+    attempt = row[0]
+    if attempt > settings.job_max_attempts:
+        # Only reachable when the last allowed attempt was interrupted and reclaimed
+        logger.error(f"Job {job_id} out of attempts: {row[2]}")
+        _fail(job_id, job_type, row[2] or "Out of attempts", cleanup, on_failure)
+        return None
+
+    checkpoints = row[1] if isinstance(row[1], dict) else json.loads(row[1] or "{}")
+    run = JobRun(job_id, component, attempt, checkpoints)
+
+    stop_heartbeat = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job_id, stop_heartbeat), name=f"heartbeat-{job_id}", daemon=True).start()
+    try:
+        with span(component, "process_job"):
+            pipeline(run)
+    except PermanentJobError as e:
+        logger.error(f"Job {job_id} failed: {e}")
+        _fail(job_id, job_type, str(e), cleanup, on_failure)
+        return None
+    except Exception as e:
+        if attempt < settings.job_max_attempts:
+            delay = retry_delay(attempt)
+            JOBS_PROCESSED.labels(job_type, "retrying").inc()
+            logger.warning(f"Job {job_id} attempt {attempt} failed, retrying in {delay:.0f}s: {e}")
+            with get_db() as db:
+                db.execute(
+                    text(
+                        "UPDATE jobs SET status = 'pending', error = :err, "
+                        "run_after = NOW() + make_interval(secs => :delay) WHERE id = :id"
+                    ),
+                    {"err": str(e), "delay": delay, "id": job_id},
+                )
+            return delay
+
+        logger.error(f"Job {job_id} failed after {attempt} attempts: {e}")
+        _fail(job_id, job_type, str(e), cleanup, on_failure)
+        return None
+    finally:
+        stop_heartbeat.set()
+
+    JOBS_PROCESSED.labels(job_type, "completed").inc()
+    if cleanup:
+        cleanup()
+    return None
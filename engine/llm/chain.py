@@ -4,10 +4,10 @@ import json
 import logging
 from typing import Optional
 
-import chromadb
-from openai import OpenAI
-
-from config import settings
+from clients import chroma_client, openai_client
+from llm.embeddings import collection_name, get_backend
+from metrics import span
+from ratelimit import INTERACTIVE, call, estimate_tokens
 
 logger = logging.getLogger(__name__)
 
@@ -42,18 +42,17 @@ If you don't know something, say so naturally — don't make things up."""
 
 def query_rag(user_id: str, question: str, top_k: int = 5) -> list[str]:
     """Query ChromaDB for relevant product chunks."""
-    client = OpenAI(api_key=settings.openai_api_key)
-    embedding = client.embeddings.create(
-        model="text-embedding-3-small", input=[question]
-    ).data[0].embedding
-
-    chroma = chromadb.HttpClient(host=settings.chroma_host, port=settings.chroma_port)
+    backend = get_backend(user_id)
     try:
-        collection = chroma.get_collection(f"product_embeddings_{user_id}")
+        collection = chroma_client().get_collection(collection_name(user_id, backend))
     except Exception:
         return []
 
-    results = collection.query(query_embeddings=[embedding], n_results=top_k)
+    with span("chain", "embed_query"):
+        embedding = backend.embed([question], priority=INTERACTIVE)[0]
+
+    with span("chain", "chroma_query"):
+        results = collection.query(query_embeddings=[embedding], n_results=top_k)
     return results["documents"][0] if results["documents"] else []
 
 
@@ -66,7 +65,8 @@ def generate_response(
 ) -> str:
     """Generate a persona-aware, RAG-enhanced response."""
     system_prompt = build_system_prompt(persona)
-    rag_context = query_rag(user_id, question)
+    with span("chain", "rag"):
+        rag_context = query_rag(user_id, question)
 
     context_block = ""
     if rag_context:
@@ -87,14 +87,20 @@ Customer question: {question}
 
 Respond naturally as {persona.get('name', 'the persona')} would."""
 
-    client = OpenAI(api_key=settings.openai_api_key)
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.7,
-        max_tokens=500,
-    )
+    client = openai_client()
+    with span("chain", "llm"):
+        response = call(
+            "openai",
+            lambda: client.chat.completions.with_raw_response.create(
+                model="gpt-4o",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt},
+                ],
+                temperature=0.7,
+                max_tokens=500,
+            ),
+            tokens=estimate_tokens(system_prompt, user_prompt) + 500,
+            priority=INTERACTIVE,
+        )
     return response.choices[0].message.content
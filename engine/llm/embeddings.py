@@ -0,0 +1,96 @@
+"""Embedding backends — OpenAI API or a local CPU model, selectable per tenant."""
+
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+from typing import List
+
+from clients import openai_client
+from config import settings
+from ratelimit import BACKGROUND, call, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPENAI_MODEL = "text-embedding-3-small"
+
+
+class OpenAIEmbeddings:
+    """Embeddings from the OpenAI API, throttled by the shared rate limiter."""
+
+    def __init__(self, model: str = DEFAULT_OPENAI_MODEL):
+        self.model = model
+
+    def embed(self, texts: List[str], priority: str = BACKGROUND) -> List[List[float]]:
+        client = openai_client()
+        response = call(
+            "openai",
+            lambda: client.embeddings.with_raw_response.create(model=self.model, input=texts),
+            tokens=estimate_tokens(*texts),
+            priority=priority,
+        )
+        return [item.embedding for item in response.data]
+
+
+class LocalEmbeddings:
+    """Embeddings from a sentence-transformers model running on the local CPU.
+
+    Parallelism comes from torch's intra-op thread pool, capped at ``threads``.
+    Encodes are serialized because the model's fast tokenizer is not safe to
+    share across threads.
+    """
+
+    def __init__(self, model: str, threads: int, batch_size: int = 64):
+        self.model = model
+        self.batch_size = batch_size
+        self._threads = threads
+        self._encoder = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._encoder is None:
+            try:
+                import torch
+                from sentence_transformers import SentenceTransformer
+            except ImportError as e:
+                raise RuntimeError(
+                    "EMBEDDING_BACKEND=local requires sentence-transformers (see requirements-local.txt)"
+                ) from e
+            torch.set_num_threads(self._threads)
+            logger.info(f"Loading local embedding model {self.model} ({self._threads} threads)")
+            self._encoder = SentenceTransformer(self.model, device="cpu")
+        return self._encoder
+
+    def embed(self, texts: List[str], priority: str = BACKGROUND) -> List[List[float]]:
+        with self._lock:
+            vectors = self._load().encode(
+                texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True
+            )
+        return vectors.tolist()
+
+
+@lru_cache(maxsize=None)
+def _backend(name: str):
+    if name == "openai":
+        return OpenAIEmbeddings()
+    if name == "local":
+        return LocalEmbeddings(settings.local_embedding_model, settings.embedding_threads)
+    raise ValueError(f"Unknown embedding backend: {name}")
+
+
+def get_backend(user_id: str):
+    """Embedding backend for a tenant: its override, else the global default."""
+    return _backend(settings.tenant_embedding_backends.get(user_id, settings.embedding_backend))
+
+
+def collection_name(user_id: str, backend) -> str:
+    """Chroma collection holding ``user_id``'s product vectors for ``backend``'s model.
+
+    Each model gets its own collection so vectors of different models are never
+    mixed. The default OpenAI model keeps the original, unsuffixed name.
+    """
+    if isinstance(backend, OpenAIEmbeddings) and backend.model == DEFAULT_OPENAI_MODEL:
+        return f"product_embeddings_{user_id}"
+    # Chroma caps names at 63 characters, so use a short hash of the model name
+    digest = hashlib.sha1(backend.model.encode()).hexdigest()[:6]
+    return f"product_embeddings_{user_id}_{digest}"
@@ -0,0 +1,145 @@
+"""Stage timing and Prometheus metrics shared by all engine workers."""
+
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+from sqlalchemy import text
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Redis lists the web app pushes job ids onto (see web/lib/redis.ts). The rag
+# worker polls the jobs table but removes each id it picks up from "rag_ingest".
+REDIS_QUEUES = ("voice_clone", "rag_ingest")
+
+STAGE_SECONDS = Histogram(
+    "echome_stage_duration_seconds",
+    "Duration of a pipeline stage",
+    ["component", "stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300),
+)
+STAGE_ERRORS = Counter(
+    "echome_stage_errors_total",
+    "Pipeline stages that raised an exception",
+    ["component", "stage"],
+)
+JOBS_PROCESSED = Counter(
+    "echome_jobs_processed_total",
+    "Jobs finished by a worker, by outcome",
+    ["type", "status"],
+)
+MESSAGES_HANDLED = Counter(
+    "echome_messages_handled_total",
+    "Channel messages handled, by outcome",
+    ["channel", "status"],
+)
+RATE_LIMIT_WAIT = Histogram(
+    "echome_rate_limit_wait_seconds",
+    "Time spent waiting for shared provider rate-limit capacity",
+    ["provider", "priority"],
+    buckets=(0.001, 0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 300),
+)
+RATE_LIMITED = Counter(
+    "echome_rate_limited_total",
+    "Provider calls rejected with HTTP 429",
+    ["provider", "priority"],
+)
+WORKER_IMPORT_SECONDS = Gauge(
+    "echome_worker_import_seconds",
+    "Time taken to import a worker module at startup",
+    ["worker"],
+)
+
+
+@contextmanager
+def span(component: str, stage: str):
+    """Time a block of work and record it under ``component``/``stage``.
+
+    Cancelled blocks (e.g. a superseded chat reply) never finished the stage,
+    so their partial duration is logged but not recorded.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except asyncio.CancelledError:
+        logger.info(f"{component}.{stage} cancelled after {(time.perf_counter() - start) * 1000:.0f} ms")
+        raise
+    except Exception:
+        STAGE_ERRORS.labels(component, stage).inc()
+        _observe(component, stage, start)
+        raise
+    _observe(component, stage, start)
+
+
+def _observe(component: str, stage: str, start: float):
+    elapsed = time.perf_counter() - start
+    STAGE_SECONDS.labels(component, stage).observe(elapsed)
+    logger.info(f"{component}.{stage} took {elapsed * 1000:.0f} ms")
+
+
+class QueueCollector:
+    """Reports queue depth and job age from the jobs table and Redis on each scrape."""
+
+    def collect(self):
+        depth = GaugeMetricFamily(
+            "echome_jobs", "Jobs in the jobs table by type and status", labels=["type", "status"]
+        )
+        oldest = GaugeMetricFamily(
+            "echome_oldest_pending_job_age_seconds",
+            "Age of the oldest pending job by type",
+            labels=["type"],
+        )
+        redis_depth = GaugeMetricFamily(
+            "echome_redis_queue_length", "Job ids waiting in a Redis queue", labels=["queue"]
+        )
+
+        try:
+            from db import get_db
+
+            with get_db() as db:
+                rows = db.execute(
+                    text(
+                        "SELECT type, status, COUNT(*), "
+                        "EXTRACT(EPOCH FROM NOW() - MIN(created_at)) "
+                        "FROM jobs WHERE status IN ('pending', 'processing') "
+                        "GROUP BY type, status"
+                    )
+                ).fetchall()
+            for job_type, status, count, age in rows:
+                depth.add_metric([job_type, status], count)
+                if status == "pending":
+                    oldest.add_metric([job_type], float(age or 0))
+        except Exception as e:
+            logger.warning(f"Could not collect job metrics: {e}")
+
+        try:
+            from clients import redis_client
+
+            for queue in REDIS_QUEUES:
+                redis_depth.add_metric([queue], redis_client().llen(queue))
+        except Exception as e:
+            logger.warning(f"Could not collect Redis queue metrics: {e}")
+
+        yield depth
+        yield oldest
+        yield redis_depth
+
+
+_server_started = False
+
+
+def start_metrics_server(collect_queues: bool = True):
+    """Expose ``/metrics`` on ``settings.metrics_port`` (0 disables it)."""
+    global _server_started
+    if _server_started or not settings.metrics_port:
+        return
+    if collect_queues:
+        REGISTRY.register(QueueCollector())
+    start_http_server(settings.metrics_port)
+    _server_started = True
+    logger.info(f"Metrics available on :{settings.metrics_port}/metrics")
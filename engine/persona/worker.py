@@ -2,10 +2,18 @@
 
 import json
 import logging
+import threading
+import time
 from pathlib import Path
+from typing import Optional
 
-from openai import OpenAI
+from sqlalchemy import text
+
+from clients import openai_client
 from config import settings
+from jobs import PermanentJobError, complete, reclaim_stale_jobs, run_job
+from metrics import start_metrics_server
+from ratelimit import BACKGROUND, call, estimate_tokens
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [persona] %(message)s")
 logger = logging.getLogger(__name__)
@@ -37,23 +45,33 @@ Return ONLY valid JSON, no markdown."""
 
 def transcribe_audio(audio_path: Path) -> str:
     """Transcribe audio using OpenAI Whisper API."""
-    client = OpenAI(api_key=settings.openai_api_key)
-    with open(audio_path, "rb") as f:
-        result = client.audio.transcriptions.create(model="whisper-1", file=f)
-    return result.text
+    client = openai_client()
+
+    def transcribe():
+        with open(audio_path, "rb") as f:
+            return client.audio.transcriptions.with_raw_response.create(model="whisper-1", file=f)
+
+    return call("openai", transcribe, priority=BACKGROUND).text
 
 
 def extract_persona(transcript: str) -> dict:
     """Use LLM to extract persona traits from transcript."""
-    client = OpenAI(api_key=settings.openai_api_key)
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are an expert at analyzing communication styles and extracting persona profiles."},
-            {"role": "user", "content": PERSONA_EXTRACTION_PROMPT.format(transcript=transcript[:15000])},
-        ],
-        response_format={"type": "json_object"},
-        temperature=0.3,
+    client = openai_client()
+    prompt = PERSONA_EXTRACTION_PROMPT.format(transcript=transcript[:15000])
+    response = call(
+        "openai",
+        lambda: client.chat.completions.with_raw_response.create(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": "You are an expert at analyzing communication styles and extracting persona profiles."},
+                {"role": "user", "content": prompt},
+            ],
+            response_format={"type": "json_object"},
+            temperature=0.3,
+        ),
+        # Output is uncapped; budget roughly one profile's worth of tokens
+        tokens=estimate_tokens(prompt) + 1000,
+        priority=BACKGROUND,
     )
     return json.loads(response.choices[0].message.content)
 
@@ -62,10 +80,7 @@ def process_job(job_id: str, user_id: str, persona_id: str):
     """Full persona extraction pipeline."""
     from db import get_db
 
-    with get_db() as db:
-        db.execute("UPDATE jobs SET status = 'processing', started_at = NOW() WHERE id = :id", {"id": job_id})
-
-    try:
+    def pipeline(run):
         # Find the audio file
         audio_dir = Path(settings.data_dir) / "audio" / user_id
         audio_file = None
@@ -76,46 +91,46 @@ def process_job(job_id: str, user_id: str, persona_id: str):
                 break
 
         if not audio_file:
-            raise FileNotFoundError(f"No audio found for user {user_id}")
+            raise PermanentJobError(f"No audio found for user {user_id}")
 
         logger.info(f"Transcribing {audio_file}")
-        transcript = transcribe_audio(audio_file)
+        transcript = run.stage("transcribe", transcribe_audio, audio_file)
 
         logger.info("Extracting persona traits via LLM")
-        profile = extract_persona(transcript)
+        profile = run.stage("extract_persona", extract_persona, transcript)
 
         with get_db() as db:
             db.execute(
-                "UPDATE personas SET transcript = :t, auto_profile = :p, updated_at = NOW() WHERE id = :pid",
+                text("UPDATE personas SET transcript = :t, auto_profile = :p, updated_at = NOW() WHERE id = :pid"),
                 {"t": transcript, "p": json.dumps(profile), "pid": persona_id},
             )
-            db.execute(
-                "UPDATE jobs SET status = 'completed', completed_at = NOW(), output = :out WHERE id = :id",
-                {"out": json.dumps(profile), "id": job_id},
-            )
+            complete(db, job_id, profile)
         logger.info(f"Persona extraction complete for {persona_id}")
 
-    except Exception as e:
-        logger.error(f"Job {job_id} failed: {e}")
-        with get_db() as db:
-            db.execute(
-                "UPDATE jobs SET status = 'failed', error = :err, completed_at = NOW() WHERE id = :id",
-                {"err": str(e), "id": job_id},
-            )
+    run_job(job_id, "persona_extract", "persona", pipeline)
 
 
-if __name__ == "__main__":
+def run(stop_event: Optional[threading.Event] = None):
+    """Poll for persona extraction jobs until ``stop_event`` is set."""
+    from db import get_db
+
+    stop_event = stop_event or threading.Event()
     logger.info("Persona worker started — polling for jobs...")
-    import time
+    last_reclaim = 0.0
 
-    while True:
-        from db import get_db
+    while not stop_event.is_set():
+        if time.monotonic() - last_reclaim >= settings.job_reclaim_interval_seconds:
+            reclaim_stale_jobs(["persona_extract"])
+            last_reclaim = time.monotonic()
 
         with get_db() as db:
             result = db.execute(
-                "SELECT j.id, j.user_id, j.input FROM jobs j "
-                "WHERE j.type = 'persona_extract' AND j.status = 'pending' "
-                "ORDER BY j.created_at LIMIT 1"
+                text(
+                    "SELECT j.id, j.user_id, j.input FROM jobs j "
+                    "WHERE j.type = 'persona_extract' AND j.status = 'pending' "
+                    "AND (j.run_after IS NULL OR j.run_after <= NOW()) "
+                    "ORDER BY j.created_at LIMIT 1"
+                )
             ).fetchone()
 
         if result:
@@ -126,4 +141,9 @@ if __name__ == "__main__":
                 persona_id=job_input["persona_id"],
             )
         else:
-            time.sleep(5)
+            stop_event.wait(5)
+
+
+if __name__ == "__main__":
+    start_metrics_server()
+    run()
@@ -1,28 +1,48 @@
 """RAG ingestion worker — parses documents, chunks, embeds, stores in ChromaDB."""
 
+import csv
+import io
 import json
 import logging
+import shutil
+import threading
+import time
+from functools import lru_cache
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
-import chromadb
-from openai import OpenAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from sqlalchemy import text
 
+from clients import chroma_client, redis_client
 from config import settings
+from jobs import PermanentJobError, complete, reclaim_stale_jobs, run_job
+from llm.embeddings import collection_name, get_backend
+from metrics import span, start_metrics_server
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [rag] %(message)s")
 logger = logging.getLogger(__name__)
 
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=512,
-    chunk_overlap=50,
-    length_function=len,
-)
 
+# The web app also pushes job ids here; jobs are polled from the DB, so the
+# worker only removes ids from the list to keep its length meaningful
+QUEUE = "rag_ingest"
 
-def get_chroma_client():
-    return chromadb.HttpClient(host=settings.chroma_host, port=settings.chroma_port)
+# Chunks per embeddings request; progress is checkpointed after each batch
+EMBED_BATCH_SIZE = 256
+# Rows per COPY statement and vectors per Chroma upsert
+PERSIST_BATCH_SIZE = 1000
+
+
+@lru_cache(maxsize=None)
+def get_text_splitter():
+    # langchain is slow to import, so load it with the first job
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(
+        chunk_size=512,
+        chunk_overlap=50,
+        length_function=len,
+    )
 
 
 def parse_document(file_path: Path) -> str:
@@ -30,7 +50,6 @@ def parse_document(file_path: Path) -> str:
     suffix = file_path.suffix.lower()
 
     if suffix == ".csv":
-        import csv
         rows = []
         with open(file_path, "r") as f:
             reader = csv.DictReader(f)
@@ -47,89 +66,201 @@ def parse_document(file_path: Path) -> str:
         return file_path.read_text()
 
     else:
-        raise ValueError(f"Unsupported file type: {suffix}")
+        raise PermanentJobError(f"Unsupported file type: {suffix}")
+
+
+def embed_chunks(run, work_dir: Path, backend, chunks: List[str]):
+    """Embed ``chunks`` in batches, checkpointing the offset reached after each one.
+
+    Each batch's vectors are kept in ``work_dir`` as float32 ``.npy`` files, so
+    a retry reloads finished batches and only pays for the ones that never
+    completed. Batches from a different embedding model are discarded rather
+    than mixed in. Returns a float32 array with one row per chunk.
+    """
+    import numpy as np
+
+    progress = run.checkpoints.get("embed") or {}
+    resumable = progress.get("total") == len(chunks) and progress.get("model") == backend.model
+    done = progress.get("offset", 0) if resumable else 0
+    batch_files = [work_dir / f"embeddings_{start}.npy" for start in range(0, done, EMBED_BATCH_SIZE)]
+    if not all(f.exists() for f in batch_files):
+        done, batch_files = 0, []
+
+    batches = [np.load(f) for f in batch_files]
+    if done:
+        logger.info(f"Resuming embeddings at chunk {done}/{len(chunks)}")
+
+    for start in range(done, len(chunks), EMBED_BATCH_SIZE):
+        with span("rag", "embed_batch"):
+            batch = np.asarray(backend.embed(chunks[start:start + EMBED_BATCH_SIZE]), dtype=np.float32)
+        np.save(work_dir / f"embeddings_{start}.npy", batch)
+        batches.append(batch)
+        run.save("embed", {"offset": start + len(batch), "total": len(chunks), "model": backend.model})
+    return np.concatenate(batches) if batches else np.empty((0, 0), dtype=np.float32)
+
 
+@lru_cache(maxsize=None)
+def get_encoding():
+    import tiktoken
 
-def embed_texts(texts: List[str]) -> List[List[float]]:
-    """Generate embeddings via OpenAI."""
-    client = OpenAI(api_key=settings.openai_api_key)
-    response = client.embeddings.create(model="text-embedding-3-small", input=texts)
-    return [item.embedding for item in response.data]
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(texts: List[str]) -> List[int]:
+    """Token counts under the OpenAI cl100k_base tokenizer."""
+    return [len(tokens) for tokens in get_encoding().encode_ordinary_batch(texts)]
+
+
+def delete_vectors(collection, product_id: str):
+    """Best-effort removal of every vector stored for a product."""
+    try:
+        collection.delete(where={"product_id": product_id})
+    except Exception as e:
+        logger.warning(f"Could not delete vectors for product {product_id}: {e}")
+
+
+def discard_vectors(user_id: str, product_id: str):
+    """Remove a product's vectors after its ingest job has failed for good."""
+    try:
+        collection = chroma_client().get_collection(collection_name(user_id, get_backend(user_id)))
+    except Exception as e:
+        logger.warning(f"Could not open vector collection for user {user_id}: {e}")
+        return
+    delete_vectors(collection, product_id)
+
+
+def store_chunks(db, collection, product_id: str, chunks: List[str], embeddings):
+    """Bulk-write chunk rows with COPY and upsert their vectors, inside ``db``'s transaction.
+
+    ``embeddings`` is the float32 array from ``embed_chunks``, one row per chunk.
+
+    Rows are written first and only committed by the caller once every vector is
+    in Chroma, so a failure leaves no committed rows without vectors. The caller
+    deletes the product's vectors if anything fails before the commit. If the
+    worker dies mid-write, the job is reclaimed (see ``jobs.reclaim_stale_jobs``)
+    and either retried, which clears the product's rows and vectors before
+    writing, or failed for good, which removes them via ``discard_vectors``.
+    """
+    ids = [f"{product_id}_{i}" for i in range(len(chunks))]
+    token_counts = count_tokens(chunks)
+
+    db.execute(text("DELETE FROM product_chunks WHERE product_id = :pid"), {"pid": product_id})
+    delete_vectors(collection, product_id)
+
+    with span("rag", "copy_chunks"):
+        cursor = db.connection().connection.cursor()
+        try:
+            for start in range(0, len(chunks), PERSIST_BATCH_SIZE):
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                for i in range(start, min(start + PERSIST_BATCH_SIZE, len(chunks))):
+                    writer.writerow([product_id, chunks[i], i, token_counts[i], ids[i]])
+                buf.seek(0)
+                cursor.copy_expert(
+                    "COPY product_chunks (product_id, content, chunk_index, token_count, embedding_id) "
+                    "FROM STDIN WITH (FORMAT csv)",
+                    buf,
+                )
+        finally:
+            cursor.close()
+
+    with span("rag", "chroma_upsert"):
+        for start in range(0, len(chunks), PERSIST_BATCH_SIZE):
+            end = start + PERSIST_BATCH_SIZE
+            collection.upsert(
+                ids=ids[start:end],
+                embeddings=embeddings[start:end].tolist(),
+                documents=chunks[start:end],
+                metadatas=[{"product_id": product_id, "chunk_index": i} for i in range(start, min(end, len(chunks)))],
+            )
 
 
 def process_job(job_id: str, user_id: str, product_id: str, file_path: str):
     """Full RAG ingestion pipeline."""
     from db import get_db
 
-    with get_db() as db:
-        db.execute("UPDATE jobs SET status = 'processing', started_at = NOW() WHERE id = :id", {"id": job_id})
+    work_dir = Path(settings.data_dir) / "rag" / job_id
+    work_dir.mkdir(parents=True, exist_ok=True)
 
-    try:
+    def pipeline(run):
+        # Parsing and chunking are cheap and deterministic, so they simply rerun
         path = Path(file_path)
+        if not path.exists():
+            raise PermanentJobError(f"Uploaded file not found: {path}")
         logger.info(f"Parsing {path}")
-        text = parse_document(path)
+        with span("rag", "parse"):
+            document = parse_document(path)
 
         logger.info("Chunking document")
-        chunks = text_splitter.split_text(text)
+        with span("rag", "chunk"):
+            chunks = get_text_splitter().split_text(document)
         logger.info(f"Created {len(chunks)} chunks")
 
-        logger.info("Generating embeddings")
-        embeddings = embed_texts(chunks)
-
-        logger.info("Storing in ChromaDB")
-        chroma = get_chroma_client()
-        collection = chroma.get_or_create_collection(f"product_embeddings_{user_id}")
-
-        ids = [f"{product_id}_{i}" for i in range(len(chunks))]
-        metadatas = [{"product_id": product_id, "chunk_index": i} for i in range(len(chunks))]
+        backend = get_backend(user_id)
+        logger.info(f"Generating embeddings with {backend.model}")
+        with span("rag", "embed"):
+            embeddings = embed_chunks(run, work_dir, backend, chunks)
 
-        collection.add(
-            ids=ids,
-            embeddings=embeddings,
-            documents=chunks,
-            metadatas=metadatas,
+        logger.info("Storing chunks in PostgreSQL and ChromaDB")
+        collection = chroma_client().get_or_create_collection(
+            collection_name(user_id, backend), metadata={"embedding_model": backend.model}
         )
 
-        # Store chunk references in PostgreSQL
-        with get_db() as db:
-            for i, chunk in enumerate(chunks):
-                db.execute(
-                    "INSERT INTO product_chunks (product_id, content, chunk_index, embedding_id) "
-                    "VALUES (:pid, :content, :idx, :eid)",
-                    {"pid": product_id, "content": chunk, "idx": i, "eid": ids[i]},
-                )
-            db.execute(
-                "UPDATE jobs SET status = 'completed', completed_at = NOW(), "
-                "output = :out WHERE id = :id",
-                {"out": json.dumps({"chunks": len(chunks)}), "id": job_id},
-            )
+        # Rows, vectors and job completion commit together or not at all
+        try:
+            with span("rag", "store_chunks"), get_db() as db:
+                store_chunks(db, collection, product_id, chunks, embeddings)
+                complete(db, job_id, {"chunks": len(chunks)})
+        except Exception:
+            delete_vectors(collection, product_id)
+            raise
 
         logger.info(f"RAG ingestion complete — {len(chunks)} chunks stored")
 
+    # Saved embedding batches are only needed while the job can still be retried
+    run_job(
+        job_id,
+        "rag_ingest",
+        "rag",
+        pipeline,
+        cleanup=lambda: shutil.rmtree(work_dir, ignore_errors=True),
+        on_failure=lambda: discard_vectors(user_id, product_id),
+    )
+
+
+def dequeue(job_id: str):
+    """Drop a picked-up job's id from the Redis list the web app pushed it onto."""
+    try:
+        redis_client().lrem(QUEUE, 0, job_id)
     except Exception as e:
-        logger.error(f"Job {job_id} failed: {e}")
-        with get_db() as db:
-            db.execute(
-                "UPDATE jobs SET status = 'failed', error = :err, completed_at = NOW() WHERE id = :id",
-                {"err": str(e), "id": job_id},
-            )
+        logger.warning(f"Could not remove job {job_id} from Redis queue '{QUEUE}': {e}")
 
 
-if __name__ == "__main__":
+def run(stop_event: Optional[threading.Event] = None):
+    """Poll for RAG ingestion jobs until ``stop_event`` is set."""
+    from db import get_db
+
+    stop_event = stop_event or threading.Event()
     logger.info("RAG worker started — polling for jobs...")
-    import time
+    last_reclaim = 0.0
 
-    while True:
-        from db import get_db
+    while not stop_event.is_set():
+        if time.monotonic() - last_reclaim >= settings.job_reclaim_interval_seconds:
+            reclaim_stale_jobs(["rag_ingest"])
+            last_reclaim = time.monotonic()
 
         with get_db() as db:
             result = db.execute(
-                "SELECT j.id, j.user_id, j.input FROM jobs j "
-                "WHERE j.type = 'rag_ingest' AND j.status = 'pending' "
-                "ORDER BY j.created_at LIMIT 1"
+                text(
+                    "SELECT j.id, j.user_id, j.input FROM jobs j "
+                    "WHERE j.type = 'rag_ingest' AND j.status = 'pending' "
+                    "AND (j.run_after IS NULL OR j.run_after <= NOW()) "
+                    "ORDER BY j.created_at LIMIT 1"
+                )
             ).fetchone()
 
         if result:
+            dequeue(str(result[0]))
             job_input = json.loads(result[2]) if isinstance(result[2], str) else result[2]
             process_job(
                 job_id=str(result[0]),
@@ -138,4 +269,9 @@ if __name__ == "__main__":
                 file_path=job_input["file_path"],
             )
         else:
-            time.sleep(5)
+            stop_event.wait(5)
+
+
+if __name__ == "__main__":
+    start_metrics_server()
+    run()
@@ -0,0 +1,247 @@
+"""Shared Redis token-bucket limiter for OpenAI and ElevenLabs calls.
+
+Every engine process draws from the same per-provider buckets (requests/min and
+tokens/min), so a large background ingest cannot starve live chat replies.
+Background callers must leave a reserve of each bucket untouched, which only
+interactive callers may spend.
+"""
+
+import logging
+import random
+import re
+import time
+from functools import lru_cache
+from typing import Callable, Optional, TypeVar
+
+from clients import redis_client
+from config import settings
+from metrics import RATE_LIMIT_WAIT, RATE_LIMITED
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# Refill both buckets for elapsed time, then take 1 request and ARGV[3] tokens
+# if the levels stay above the caller's reserve. Returns seconds to wait
+# (as a string, since Lua numbers are truncated to integers on the way out).
+_ACQUIRE_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local blocked = tonumber(redis.call('GET', KEYS[3]) or '0')
+if blocked > now then
+  return tostring(blocked - now)
+end
+
+local function level(key, cap)
+  local b = redis.call('HMGET', key, 'tokens', 'ts')
+  local tokens = tonumber(b[1]) or cap
+  local ts = tonumber(b[2]) or now
+  return math.min(cap, tokens + (now - ts) * cap / 60)
+end
+
+local rcap = tonumber(ARGV[1])
+local tcap = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[4])
+local cost = math.min(tonumber(ARGV[3]), tcap * (1 - reserve))
+local requests = level(KEYS[1], rcap)
+local tokens = level(KEYS[2], tcap)
+
+local wait = 0
+local need_r = 1 + reserve * rcap
+local need_t = cost + reserve * tcap
+if requests < need_r then wait = math.max(wait, (need_r - requests) * 60 / rcap) end
+if tokens < need_t then wait = math.max(wait, (need_t - tokens) * 60 / tcap) end
+if wait > 0 then
+  return tostring(wait)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', requests - 1, 'ts', now)
+redis.call('HSET', KEYS[2], 'tokens', tokens - cost, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 120)
+redis.call('EXPIRE', KEYS[2], 120)
+return '0'
+"""
+
+_BLOCK_LUA = """
+local t = redis.call('TIME')
+local until_ts = tonumber(t[1]) + tonumber(t[2]) / 1000000 + tonumber(ARGV[1])
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if until_ts > current then
+  redis.call('SET', KEYS[1], tostring(until_ts), 'EX', math.ceil(tonumber(ARGV[1])) + 1)
+end
+return 1
+"""
+
+
+@lru_cache(maxsize=None)
+def _script(source: str):
+    return redis_client().register_script(source)
+
+
+def _limits(provider: str) -> tuple[int, int]:
+    if provider == "openai":
+        return settings.openai_rpm, settings.openai_tpm
+    if provider == "elevenlabs":
+        return settings.elevenlabs_rpm, settings.elevenlabs_cpm
+    raise ValueError(f"Unknown provider: {provider}")
+
+
+def acquire(provider: str, tokens: int = 0, priority: str = BACKGROUND):
+    """Block until ``provider`` has capacity for one request of ``tokens`` tokens.
+
+    Raises TimeoutError if the wait exceeds the priority's maximum. If Redis is
+    unreachable the call is let through rather than failing the caller.
+    """
+    import redis
+
+    rpm, tpm = _limits(provider)
+    reserve = 0 if priority == INTERACTIVE else settings.rate_limit_reserve
+    max_wait = (
+        settings.rate_limit_max_wait_interactive
+        if priority == INTERACTIVE
+        else settings.rate_limit_max_wait_background
+    )
+    keys = [f"ratelimit:{provider}:requests", f"ratelimit:{provider}:tokens", f"ratelimit:{provider}:blocked"]
+
+    start = time.monotonic()
+    while True:
+        try:
+            wait = float(_script(_ACQUIRE_LUA)(keys=keys, args=[rpm, tpm, max(tokens, 0), reserve]))
+        except redis.RedisError as e:
+            logger.warning(f"Rate limiter unavailable, not throttling {provider}: {e}")
+            return
+
+        waited = time.monotonic() - start
+        if wait <= 0:
+            RATE_LIMIT_WAIT.labels(provider, priority).observe(waited)
+            return
+        if waited + wait > max_wait:
+            raise TimeoutError(f"{provider} rate limit: no capacity within {max_wait:.0f}s ({priority})")
+        # Jitter so workers woken by the same refill do not stampede the script
+        time.sleep(wait + random.uniform(0, 0.05))
+
+
+def block(provider: str, seconds: float):
+    """Pause every caller of ``provider`` for ``seconds``, across all workers."""
+    if seconds <= 0:
+        return
+    import redis
+
+    try:
+        _script(_BLOCK_LUA)(keys=[f"ratelimit:{provider}:blocked"], args=[seconds])
+    except redis.RedisError as e:
+        logger.warning(f"Could not record {provider} backoff: {e}")
+    logger.warning(f"{provider} backing off for {seconds:.1f}s")
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """Parse ``retry-after`` / OpenAI reset values such as ``20``, ``1s``, ``6m0s`` or ``250ms``."""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(n) * scale[unit] for n, unit in parts)
+
+
+def observe_headers(provider: str, headers) -> Optional[float]:
+    """Back off when the provider reports an exhausted quota. Returns the delay, if any."""
+    if headers is None:
+        return None
+
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        delay = _parse_duration(retry_after)
+        if delay:
+            block(provider, delay)
+            return delay
+
+    delay = 0.0
+    for kind in ("requests", "tokens"):
+        remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+        reset = headers.get(f"x-ratelimit-reset-{kind}")
+        if remaining is not None and reset and remaining.strip() == "0":
+            delay = max(delay, _parse_duration(reset) or 0)
+    if delay:
+        block(provider, delay)
+        return delay
+    return None
+
+
+def _error_status_and_headers(error: Exception):
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    headers = getattr(error, "headers", None) or getattr(response, "headers", None)
+    return status, headers
+
+
+# Network failures raised by the OpenAI SDK, httpx (ElevenLabs) and requests
+_TRANSIENT_ERROR_NAMES = {"APIConnectionError", "APITimeoutError", "TransportError", "TimeoutException"}
+_TRANSIENT_STATUSES = {408, 409}
+
+
+def _is_transient(error: Exception, status: Optional[int]) -> bool:
+    """Errors the SDKs would retry on their own: connection drops, timeouts, 408/409/5xx."""
+    if status is not None:
+        return status in _TRANSIENT_STATUSES or status >= 500
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return any(cls.__name__ in _TRANSIENT_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def call(
+    provider: str,
+    fn: Callable[[], T],
+    tokens: int = 0,
+    priority: str = BACKGROUND,
+    max_retries: int = 5,
+    max_transient_retries: int = 2,
+) -> T:
+    """Run ``fn`` through the shared limiter, retrying 429s with adaptive backoff.
+
+    Transient failures (connection errors, timeouts, 408/409/5xx) are retried
+    up to ``max_transient_retries`` times with jittered backoff, standing in for
+    the SDK retries that are disabled on the shared clients.
+
+    If ``fn`` returns a raw SDK response (OpenAI ``with_raw_response``), its
+    rate-limit headers are fed back into the limiter and the parsed result is
+    returned instead.
+    """
+    transient_failures = 0
+    for attempt in range(max_retries + 1):
+        acquire(provider, tokens, priority)
+        try:
+            result = fn()
+        except Exception as e:
+            status, headers = _error_status_and_headers(e)
+            if attempt == max_retries:
+                raise
+            if status == 429:
+                RATE_LIMITED.labels(provider, priority).inc()
+                if not observe_headers(provider, headers):
+                    block(provider, min(60, 2 ** attempt) + random.uniform(0, 1))
+                continue
+            if not _is_transient(e, status) or transient_failures >= max_transient_retries:
+                raise
+            transient_failures += 1
+            delay = min(8, 0.5 * 2 ** transient_failures) + random.uniform(0, 0.5)
+            logger.warning(f"{provider} call failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+
+        if hasattr(result, "headers") and hasattr(result, "parse"):
+            observe_headers(provider, result.headers)
+            return result.parse()
+        return result
+
+
+def estimate_tokens(*texts: str) -> int:
+    """Rough OpenAI token estimate (~4 characters per token)."""
+    return sum(len(t) for t in texts) // 4 + 1
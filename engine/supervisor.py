@@ -0,0 +1,120 @@
+"""Run several engine workers in one process.
+
+    python -m supervisor                  # every worker in ENGINE_WORKERS
+    python -m supervisor voice rag        # just a subset
+
+Workers share one DB pool and one client per provider (see clients.py), so a
+small host can run the whole engine in a single container.
+"""
+
+import asyncio
+import importlib
+import logging
+import os
+import resource
+import signal
+import sys
+import threading
+import time
+
+from config import settings
+from metrics import WORKER_IMPORT_SECONDS, start_metrics_server
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(threadName)s] %(message)s")
+logger = logging.getLogger("supervisor")
+
+WORKERS = {
+    "voice": "voice.worker",
+    "persona": "persona.worker",
+    "rag": "rag.worker",
+    "telegram": "channels.telegram_bot",
+}
+
+
+def rss_mb() -> float:
+    """Current resident set size in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except OSError:
+        # Not Linux: fall back to peak RSS (KB on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1e6 if sys.platform == "darwin" else 1e3)
+
+
+def load(name: str):
+    """Import a worker module, reporting how long it took and the resulting RSS."""
+    start = time.perf_counter()
+    module = importlib.import_module(WORKERS[name])
+    elapsed = time.perf_counter() - start
+    WORKER_IMPORT_SECONDS.labels(name).set(elapsed)
+    logger.info(f"Loaded {name} in {elapsed * 1000:.0f} ms — RSS {rss_mb():.0f} MB")
+    return module
+
+
+def supervise(name: str, run, stop_event: threading.Event):
+    """Run a worker loop, restarting it if it crashes."""
+    while not stop_event.is_set():
+        try:
+            run(stop_event)
+        except Exception as e:
+            logger.error(f"{name} worker crashed, restarting in 5s: {e}")
+            stop_event.wait(5)
+
+
+def supervise_telegram(run, stop_event: threading.Event):
+    """Run Telegram polling on the main thread, restarting it if it crashes.
+
+    Polling returns normally once it receives SIGINT/SIGTERM, which stops the engine.
+    """
+    while True:
+        try:
+            run()
+            return
+        except Exception as e:
+            logger.error(f"telegram worker crashed, restarting in 5s: {e}")
+        # Polling closed its event loop and removed its signal handlers on the way out
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+        signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+        if stop_event.wait(5):
+            return
+
+
+def main(names=None):
+    names = names or [n.strip() for n in settings.engine_workers.split(",") if n.strip()]
+    unknown = sorted(set(names) - set(WORKERS))
+    if unknown:
+        raise SystemExit(f"Unknown workers: {', '.join(unknown)} (choose from {', '.join(WORKERS)})")
+
+    start = time.perf_counter()
+    logger.info(f"Engine starting [{', '.join(names)}] — RSS {rss_mb():.0f} MB")
+    modules = {name: load(name) for name in names}
+    start_metrics_server()
+
+    stop_event = threading.Event()
+    threads = [
+        threading.Thread(target=supervise, args=(name, module.run, stop_event), name=name, daemon=True)
+        for name, module in modules.items()
+        if name != "telegram"
+    ]
+    for thread in threads:
+        thread.start()
+    logger.info(f"Engine ready in {(time.perf_counter() - start) * 1000:.0f} ms — RSS {rss_mb():.0f} MB")
+
+    if "telegram" in modules:
+        # Telegram polling owns the main thread and returns on SIGINT/SIGTERM
+        supervise_telegram(modules["telegram"].run, stop_event)
+    else:
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+        signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+        stop_event.wait()
+
+    logger.info("Stopping workers...")
+    stop_event.set()
+    for thread in threads:
+        thread.join(timeout=30)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,19 +4,26 @@ import os
 import subprocess
 import logging
 import json
+import threading
 import time
-import redis
 import requests
 from pathlib import Path
+from typing import Optional
 from sqlalchemy import text
 
+from clients import elevenlabs_client, redis_client
 from config import settings
+from jobs import PermanentJobError, complete, reclaim_stale_jobs, run_job
+from metrics import start_metrics_server
+from ratelimit import BACKGROUND, call
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [voice] %(message)s")
 logger = logging.getLogger(__name__)
 
-# Redis client
-redis_client = redis.from_url(settings.redis_url)
+QUEUE = "voice_clone"
+# Sorted set of job ids waiting out their retry backoff, scored by due time
+RETRY_QUEUE = "voice_clone:retry"
+JOB_TYPES = ["voice_extract", "voice_clone", "voice_clone_from_extract"]
 
 
 def download_audio(youtube_url: str, output_dir: Path) -> Path:
@@ -103,43 +110,38 @@ def clean_audio(input_path: Path, output_path: Path) -> Path:
 
 def clone_voice(audio_path: Path, name: str) -> str:
     """Clone voice via ElevenLabs API. Returns voice_id."""
-    from elevenlabs import ElevenLabs
+    client = elevenlabs_client()
 
-    client = ElevenLabs(api_key=settings.elevenlabs_api_key)
-    with open(audio_path, "rb") as f:
-        voice = client.clone(name=name, files=[f])
+    def clone():
+        with open(audio_path, "rb") as f:
+            return client.clone(name=name, files=[f])
+
+    voice = call("elevenlabs", clone, priority=BACKGROUND)
     logger.info(f"Voice cloned: {voice.voice_id}")
     return voice.voice_id
 
 
+def _file_exists(path) -> bool:
+    return bool(path) and Path(path).exists()
+
+
 def process_extract_job(job_id: str, user_id: str, youtube_url: str):
     """Extract MP3 only for user preview."""
     from db import get_db
 
     work_dir = Path(settings.data_dir) / "audio" / user_id / job_id
     work_dir.mkdir(parents=True, exist_ok=True)
+    mp3_path = work_dir / "extracted.mp3"
 
-    with get_db() as db:
-        db.execute(text("UPDATE jobs SET status = 'processing', started_at = NOW() WHERE id = :id"), {"id": job_id})
-
-    try:
-        raw_audio = download_audio(youtube_url, work_dir)
-        mp3_path = work_dir / "extracted.mp3"
-        subprocess.run(["ffmpeg", "-y", "-i", str(raw_audio), str(mp3_path)], check=True)
+    def pipeline(run):
+        raw_audio = run.stage("download", lambda: str(download_audio(youtube_url, work_dir)), valid=_file_exists)
+        subprocess.run(["ffmpeg", "-y", "-i", raw_audio, str(mp3_path)], check=True)
 
         with get_db() as db:
-            db.execute(
-                text("UPDATE jobs SET status = 'completed', completed_at = NOW(), output = :out WHERE id = :id"),
-                {"out": json.dumps({"audio_path": str(mp3_path), "audio_file": mp3_path.name}), "id": job_id},
-            )
+            complete(db, job_id, {"audio_path": str(mp3_path), "audio_file": mp3_path.name})
         logger.info(f"Extract job {job_id} completed")
-    except Exception as e:
-        logger.error(f"Extract job {job_id} failed: {e}")
-        with get_db() as db:
-            db.execute(
-                text("UPDATE jobs SET status = 'failed', error = :err, completed_at = NOW() WHERE id = :id"),
-                {"err": str(e), "id": job_id},
-            )
+
+    return run_job(job_id, "voice_extract", "voice", pipeline)
 
 
 def process_clone_job(job_id: str, user_id: str, persona_name: str, youtube_url=None, audio_path=None):
@@ -148,49 +150,65 @@ def process_clone_job(job_id: str, user_id: str, persona_name: str, youtube_url=
 
     work_dir = Path(settings.data_dir) / "audio" / user_id / job_id
     work_dir.mkdir(parents=True, exist_ok=True)
+    clean_path = work_dir / "clean.wav"
 
-    with get_db() as db:
-        db.execute(text("UPDATE jobs SET status = 'processing', started_at = NOW() WHERE id = :id"), {"id": job_id})
-
-    try:
+    def pipeline(run):
         if audio_path:
-            raw_audio = Path(audio_path)
+            raw_audio = audio_path
         elif youtube_url:
             logger.info(f"Downloading audio from {youtube_url}")
-            raw_audio = download_audio(youtube_url, work_dir)
+            raw_audio = run.stage("download", lambda: str(download_audio(youtube_url, work_dir)), valid=_file_exists)
         else:
-            raise ValueError("Missing audio source for clone")
+            raise PermanentJobError("Missing audio source for clone")
 
-        clean_path = work_dir / "clean.wav"
-        clean_audio(raw_audio, clean_path)
-
-        voice_id = clone_voice(clean_path, persona_name)
+        run.stage("clean_audio", lambda: str(clean_audio(Path(raw_audio), clean_path)), valid=_file_exists)
+        voice_id = run.stage("clone_voice", clone_voice, clean_path, persona_name)
 
         with get_db() as db:
             db.execute(text("UPDATE personas SET voice_id = :vid, voice_status = 'ready' WHERE user_id = :uid"), {"vid": voice_id, "uid": user_id})
-            db.execute(
-                text("UPDATE jobs SET status = 'completed', completed_at = NOW(), output = :out WHERE id = :id"),
-                {"out": json.dumps({"voice_id": voice_id}), "id": job_id},
-            )
+            complete(db, job_id, {"voice_id": voice_id})
         logger.info(f"Clone job {job_id} completed — voice_id: {voice_id}")
 
-    except Exception as e:
-        logger.error(f"Clone job {job_id} failed: {e}")
-        with get_db() as db:
-            db.execute(
-                text("UPDATE jobs SET status = 'failed', error = :err, completed_at = NOW() WHERE id = :id"),
-                {"err": str(e), "id": job_id},
-            )
+    return run_job(job_id, "voice_clone", "voice", pipeline)
 
 
-if __name__ == "__main__":
-    logger.info("Voice worker started — listening on Redis queue 'voice_clone'...")
+def schedule_retry(job_id: str, delay: float):
+    """Re-queue a job on the Redis queue once its backoff has passed."""
+    redis_client().zadd(RETRY_QUEUE, {job_id: time.time() + delay})
+
+
+def requeue_stale_jobs():
+    """Put jobs orphaned by a dead voice worker back on the Redis queue."""
+    for job_id in reclaim_stale_jobs(JOB_TYPES):
+        redis_client().rpush(QUEUE, job_id)
+
+
+def promote_due_retries():
+    """Move retries whose backoff has elapsed back onto the work queue."""
+    r = redis_client()
+    for job_id in r.zrangebyscore(RETRY_QUEUE, 0, time.time()):
+        # zrem succeeds for exactly one worker, so each retry is queued once
+        if r.zrem(RETRY_QUEUE, job_id):
+            r.rpush(QUEUE, job_id)
+
+
+def run(stop_event: Optional[threading.Event] = None):
+    """Consume the Redis voice queue until ``stop_event`` is set."""
     from db import get_db
 
-    while True:
+    stop_event = stop_event or threading.Event()
+    logger.info(f"Voice worker started — listening on Redis queue '{QUEUE}'...")
+    last_reclaim = 0.0
+
+    while not stop_event.is_set():
         try:
+            if time.monotonic() - last_reclaim >= settings.job_reclaim_interval_seconds:
+                requeue_stale_jobs()
+                last_reclaim = time.monotonic()
+            promote_due_retries()
+
             # Block on Redis queue (BLPOP with 5 second timeout)
-            result = redis_client.blpop("voice_clone", timeout=5)
+            result = redis_client().blpop(QUEUE, timeout=5)
             
             if result:
                 _, job_id_bytes = result
@@ -217,22 +235,28 @@ if __name__ == "__main__":
                     youtube_url = job_input.get("youtube_url")
                     if not youtube_url:
                         raise ValueError("Missing youtube_url")
-                    process_extract_job(job_id, user_id, youtube_url)
-                    continue
-
-                persona_name = job_input.get("persona_name", "Echo Voice")
-
-                if job_type == "voice_clone_from_extract":
-                    audio_path = job_input.get("audio_path")
-                    process_clone_job(job_id, user_id, persona_name, audio_path=audio_path)
-                    continue
-
-                # legacy/default voice_clone from youtube_url
-                youtube_url = job_input.get("youtube_url")
-                if not youtube_url:
-                    raise ValueError("Missing youtube_url")
-                process_clone_job(job_id, user_id, persona_name, youtube_url=youtube_url)
+                    delay = process_extract_job(job_id, user_id, youtube_url)
+                else:
+                    persona_name = job_input.get("persona_name", "Echo Voice")
+
+                    if job_type == "voice_clone_from_extract":
+                        audio_path = job_input.get("audio_path")
+                        delay = process_clone_job(job_id, user_id, persona_name, audio_path=audio_path)
+                    else:
+                        # legacy/default voice_clone from youtube_url
+                        youtube_url = job_input.get("youtube_url")
+                        if not youtube_url:
+                            raise ValueError("Missing youtube_url")
+                        delay = process_clone_job(job_id, user_id, persona_name, youtube_url=youtube_url)
+
+                if delay:
+                    schedule_retry(job_id, delay)
                 
         except Exception as e:
             logger.error(f"Worker error: {e}")
-            time.sleep(5)
+            stop_event.wait(5)
+
+
+if __name__ == "__main__":
+    start_metrics_server()
+    run()
@@ -117,6 +117,10 @@ CREATE TABLE jobs (
     input JSONB DEFAULT '{}',
     output JSONB DEFAULT '{}',
     error TEXT,
+    checkpoints JSONB DEFAULT '{}',     -- per-stage outputs, reused when a job is retried
+    attempts INT DEFAULT 0,
+    run_after TIMESTAMPTZ,              -- retry backoff: not picked up before this time
+    heartbeat_at TIMESTAMPTZ,           -- refreshed while a worker runs the job
     started_at TIMESTAMPTZ,
     completed_at TIMESTAMPTZ,
     created_at TIMESTAMPTZ DEFAULT NOW()
@@ -124,6 +128,8 @@ CREATE TABLE jobs (
 
 CREATE INDEX idx_jobs_user ON jobs(user_id);
 CREATE INDEX idx_jobs_status ON jobs(status);
+CREATE INDEX idx_jobs_pending ON jobs(type, created_at) WHERE status = 'pending';
+CREATE INDEX idx_jobs_processing ON jobs(type, heartbeat_at) WHERE status = 'processing';
 
 -- Updated_at trigger
 CREATE OR REPLACE FUNCTION update_updated_at()
@@ -0,0 +1,9 @@
+-- Echo Me — resumable job stages (checkpoints + retry backoff)
+-- Apply to databases created before these columns were added to init.sql:
+--   docker-compose exec -T db psql -U echo echome < scripts/migrations/001_job_checkpoints.sql
+
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS checkpoints JSONB DEFAULT '{}';
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS attempts INT DEFAULT 0;
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS run_after TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_jobs_pending ON jobs(type, created_at) WHERE status = 'pending';
@@ -0,0 +1,6 @@
+-- Echo Me — job heartbeats, so jobs orphaned by a dead worker are reclaimed
+--   docker-compose exec -T db psql -U echo echome < scripts/migrations/002_job_heartbeat.sql
+
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_jobs_processing ON jobs(type, heartbeat_at) WHERE status = 'processing';